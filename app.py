@@ -1,11 +1,22 @@
 import io
+import codecs
 import csv
+import re
+import math
 import sqlite3
 import random
 import os
+import queue
+import threading
 import datetime
+import hashlib
+import hmac
+import time
+import itertools
+import functools
+from collections import OrderedDict
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, g, make_response
+from flask import Flask, render_template, request, redirect, url_for, g, Response, stream_with_context
 
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -15,104 +26,225 @@ load_dotenv()
 
 app = Flask(__name__)
 DATABASE = 'quiz.db'
+# 價錢測驗每次出的題數
+PRICE_QUIZ_SIZE = 5
+# CSV 匯入時每累積這麼多筆屬性就批次寫入一次，記憶體用量不隨檔案大小成長
+IMPORT_BATCH_SIZE = 1000
+# 讀取上傳檔案時每次讀入的位元組數
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 # --- 登入配置 ---
 auth = HTTPBasicAuth()
 
 # 設定單一管理帳號和密碼（從環境變數讀取，預設為開發用密碼）
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'Lovefatfat')
-users = {
-    "belle": generate_password_hash(ADMIN_PASSWORD, method="pbkdf2:sha256")
-}
+# pbkdf2 迭代次數：預設值遠低於 Werkzeug 的預設（數十萬次），每次驗證只需不到一毫秒。
+# 雜湊只存在記憶體中、且只有一個由環境變數設定的管理帳號，離線暴力破解的風險不適用；
+# 若密碼強度不足或有疑慮，可透過 ADMIN_HASH_ROUNDS 調高。
+ADMIN_HASH_ROUNDS = int(os.getenv('ADMIN_HASH_ROUNDS', '1000'))
+ADMIN_USERNAME = 'belle'
+
+@functools.lru_cache(maxsize=1)
+def _admin_hash():
+    """管理密碼的 pbkdf2 雜湊，第一次需要驗證時才計算，啟動行程時不必先算。"""
+    return generate_password_hash(ADMIN_PASSWORD, method=f"pbkdf2:sha256:{ADMIN_HASH_ROUNDS}")
+
+# 驗證成功的短期快取：同一組帳密在有效期內不必每個請求都重算 pbkdf2
+AUTH_CACHE_SIZE = 16
+AUTH_CACHE_TTL = 60  # 秒
+_AUTH_CACHE = OrderedDict()  # username -> (密碼的 HMAC 摘要, 到期時間)
+_AUTH_CACHE_KEY = os.urandom(32)  # 每個行程各自的隨機金鑰，摘要離開行程即無法比對
+
+def _password_digest(password):
+    """以 HMAC-SHA256 計算密碼摘要，作為快取比對用。"""
+    return hmac.new(_AUTH_CACHE_KEY, (password or '').encode('utf-8'), hashlib.sha256).digest()
 
 @auth.verify_password
 def verify_password(username, password):
     """驗證使用者名稱和密碼"""
-    if username in users and check_password_hash(users.get(username), password):
+    if username != ADMIN_USERNAME:
+        return None
+
+    digest = _password_digest(password)
+    now = time.monotonic()
+    cached = _AUTH_CACHE.get(username)
+    if cached and cached[1] > now and hmac.compare_digest(cached[0], digest):
+        _AUTH_CACHE.move_to_end(username)
         return username
-    return None
+
+    # 完整的 pbkdf2 驗證才是依據；只快取驗證成功的結果
+    if not check_password_hash(_admin_hash(), password):
+        return None
+
+    _AUTH_CACHE[username] = (digest, now + AUTH_CACHE_TTL)
+    _AUTH_CACHE.move_to_end(username)
+    while len(_AUTH_CACHE) > AUTH_CACHE_SIZE:
+        _AUTH_CACHE.popitem(last=False)
+    return username
 
 # --- 資料庫初始化與連接 ---
 
+# 連線池：重複使用已設定好 pragma 的連線，避免每個請求都重新開檔（db、-wal、-shm）；
+# 後進先出，優先取回剛用過、頁面快取最熱的那條連線
+_POOL = queue.LifoQueue(maxsize=8)
+
+def _connect():
+    """建立新的資料庫連線並套用 pragma 設定。"""
+    db = sqlite3.connect(DATABASE, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    # journal_mode=WAL 記錄在資料庫檔案中，由 init_db() 設定一次即可；以下為每條連線各自的設定
+    db.execute('PRAGMA synchronous=NORMAL')
+    # 暫存表放記憶體、約 20MB 頁面快取、128MB 記憶體映射讀取
+    db.execute('PRAGMA temp_store=MEMORY')
+    db.execute('PRAGMA cache_size=-20000')
+    db.execute('PRAGMA mmap_size=134217728')
+    # 啟用外鍵，刪除飲料時屬性與選項才會依 ON DELETE CASCADE 一併刪除
+    db.execute('PRAGMA foreign_keys=ON')
+    return db
+
 def get_db():
-    """獲取資料庫連線，並設置 row_factory 讓查詢結果以字典形式返回。"""
+    """從連線池取得資料庫連線（池中沒有時才新建），查詢結果以字典形式返回。"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _POOL.get_nowait()
+        except queue.Empty:
+            db = _connect()
+        g._database = db
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """應用程式上下文結束時關閉資料庫連線。"""
-    db = getattr(g, '_database', None)
+    """應用程式上下文結束時將連線歸還連線池，池已滿才關閉。"""
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        # 丟棄未提交的變更，避免下一個請求接手半途的交易
+        db.rollback()
+        try:
+            _POOL.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+# 既有資料庫的結構升級：每一項都可重複執行，已套用過的會被略過
+_MIGRATIONS = [
+    # 題目文字欄位（[NUM] 已替換為 ____，由 SQLite 直接算出）
+    """
+    ALTER TABLE drink_attributes ADD COLUMN rendered_question TEXT
+    GENERATED ALWAYS AS (replace(question_template, '[NUM]', '____')) VIRTUAL
+    """,
+    # 測驗依分類篩選並以 id 隨機探測時可直接走索引
+    'CREATE INDEX IF NOT EXISTS idx_drinks_category_id ON drinks(category, id)',
+    # 價錢測驗依屬性名稱找候選題目
+    'CREATE INDEX IF NOT EXISTS idx_attrs_name_drink ON drink_attributes(attribute_name, drink_id)',
+    # 出題時依屬性查詢預先定義的選項
+    'CREATE INDEX IF NOT EXISTS idx_options_attribute ON drink_attribute_options(attribute_id)',
+]
+
+_SCHEMA_STATE = {'ready': False}
+# 同一行程中多個執行緒同時處理第一個請求時，只讓一個執行 init_db()
+_SCHEMA_LOCK = threading.RLock()
 
 def init_db():
-    """初始化資料庫並創建新的表結構（飲料+屬性模式）。"""
-    with app.app_context():
+    """初始化資料庫並創建新的表結構（飲料+屬性模式），再套用尚未執行的結構升級。"""
+    with _SCHEMA_LOCK, app.app_context():
         db = get_db()
         
-        try:
-            # 1. Drinks 表 - 存放飲料基本資訊
-            db.execute("""
-                CREATE TABLE IF NOT EXISTS drinks (
-                    id INTEGER PRIMARY KEY,
-                    category TEXT NOT NULL,
-                    name TEXT NOT NULL UNIQUE,
-                    is_mastered INTEGER DEFAULT 0
-                );
-            """)
-            
-            # 2. Drink Attributes 表 - 存放飲料的各項屬性（咖啡液、牛奶等）
-            db.execute("""
-                CREATE TABLE IF NOT EXISTS drink_attributes (
-                    id INTEGER PRIMARY KEY,
-                    drink_id INTEGER NOT NULL,
-                    attribute_name TEXT NOT NULL,
-                    attribute_value TEXT NOT NULL,
-                    unit TEXT,
-                    question_template TEXT,
-                    times_attempted INTEGER DEFAULT 0,
-                    times_correct INTEGER DEFAULT 0,
-                    FOREIGN KEY (drink_id) REFERENCES drinks(id) ON DELETE CASCADE,
-                    UNIQUE(drink_id, attribute_name)
-                );
-            """)
-            
-            # 3. Drink Attribute Options 表 - 存放每個屬性的可選答案
-            db.execute("""
-                CREATE TABLE IF NOT EXISTS drink_attribute_options (
-                    id INTEGER PRIMARY KEY,
-                    attribute_id INTEGER NOT NULL,
-                    option_value TEXT NOT NULL,
-                    is_correct INTEGER DEFAULT 0,
-                    FOREIGN KEY (attribute_id) REFERENCES drink_attributes(id) ON DELETE CASCADE
-                );
-            """)
-            
-            db.commit()
-            print("✅ 資料庫表結構已建立成功！")
-            
-        except sqlite3.OperationalError as e:
-            if 'already exists' not in str(e):
-                print(f"⚠️ 資料庫初始化注意: {e}")
-            db.commit()
+        # WAL 模式讓寫入不必每次 commit 都整檔 fsync，且讀取不會被寫入阻塞（設定會保存在資料庫檔案中）
+        db.execute('PRAGMA journal_mode=WAL')
+        
+        # 1. Drinks 表 - 存放飲料基本資訊
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS drinks (
+                id INTEGER PRIMARY KEY,
+                category TEXT NOT NULL,
+                name TEXT NOT NULL UNIQUE,
+                is_mastered INTEGER DEFAULT 0
+            );
+        """)
+        
+        # 2. Drink Attributes 表 - 存放飲料的各項屬性（咖啡液、牛奶等）
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS drink_attributes (
+                id INTEGER PRIMARY KEY,
+                drink_id INTEGER NOT NULL,
+                attribute_name TEXT NOT NULL,
+                attribute_value TEXT NOT NULL,
+                unit TEXT,
+                question_template TEXT,
+                times_attempted INTEGER DEFAULT 0,
+                times_correct INTEGER DEFAULT 0,
+                rendered_question TEXT GENERATED ALWAYS AS (replace(question_template, '[NUM]', '____')) VIRTUAL,
+                FOREIGN KEY (drink_id) REFERENCES drinks(id) ON DELETE CASCADE,
+                UNIQUE(drink_id, attribute_name)
+            );
+        """)
+        
+        # 3. Drink Attribute Options 表 - 存放每個屬性的可選答案
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS drink_attribute_options (
+                id INTEGER PRIMARY KEY,
+                attribute_id INTEGER NOT NULL,
+                option_value TEXT NOT NULL,
+                is_correct INTEGER DEFAULT 0,
+                FOREIGN KEY (attribute_id) REFERENCES drink_attributes(id) ON DELETE CASCADE
+            );
+        """)
+        
+        # 4. 結構升級 - 只略過「已經套用過」的錯誤，其他錯誤照常拋出
+        for statement in _MIGRATIONS:
+            try:
+                db.execute(statement)
+            except sqlite3.OperationalError as e:
+                if 'duplicate column' not in str(e) and 'already exists' not in str(e):
+                    raise
+        db.commit()
+        
+        # 5. 補齊還沒有預先產生選項的屬性（已補齊時只是一次查詢；在寫入鎖內執行，多個行程同時啟動也不會重複寫入）
+        store_attribute_options(db)
+        
+        db.commit()
+        _SCHEMA_STATE['ready'] = True
+
+@app.before_request
+def ensure_schema():
+    """每個行程處理第一個請求前先確認資料表與結構升級都已套用（例如以 WSGI 伺服器啟動時）。"""
+    if not _SCHEMA_STATE['ready']:
+        with _SCHEMA_LOCK:
+            if not _SCHEMA_STATE['ready']:
+                init_db()
 
 # --- 核心邏輯：飲料和屬性相關函數 ---
 
+# 分類/飲料名稱清單與飲料 id 清單快取：CATEGORY_CACHE_TTL 秒內直接使用，過期後重新查詢；
+# 本行程的寫入會直接讓快取失效，其他行程（例如多個 WSGI worker）的新增、改名、刪除最多延遲一個 TTL 才看得到
+CATEGORY_CACHE_TTL = 30  # 秒
+_CAT_CACHE = {'loaded_at': None, 'cats': [], 'drinks': [], 'ids': []}
+
+def invalidate_category_cache():
+    """飲料資料被新增、修改或刪除後呼叫，強制下次重新查詢分類清單。"""
+    _CAT_CACHE['loaded_at'] = None
+
 def get_unique_categories_and_drinks():
     """從資料庫獲取所有不重複的分類和飲料名稱，供前端篩選使用。"""
+    now = time.monotonic()
+    loaded_at = _CAT_CACHE['loaded_at']
+    if loaded_at is not None and now - loaded_at < CATEGORY_CACHE_TTL:
+        return _CAT_CACHE['cats'], _CAT_CACHE['drinks']
+
     db = get_db()
     try:
         categories = db.execute('SELECT DISTINCT category FROM drinks ORDER BY category').fetchall()
         drinks = db.execute('SELECT DISTINCT name FROM drinks ORDER BY name').fetchall()
+        drink_ids = [row[0] for row in db.execute('SELECT id FROM drinks')]
     except sqlite3.OperationalError:
         init_db()
         return [], []
-    
-    return [c['category'] for c in categories], [d['name'] for d in drinks]
+
+    _CAT_CACHE['cats'] = [c['category'] for c in categories]
+    _CAT_CACHE['drinks'] = [d['name'] for d in drinks]
+    _CAT_CACHE['ids'] = drink_ids
+    _CAT_CACHE['loaded_at'] = now
+    return _CAT_CACHE['cats'], _CAT_CACHE['drinks']
 
 def get_drink_attributes(drink_id):
     """獲取指定飲料的所有屬性。"""
@@ -122,33 +254,122 @@ def get_drink_attributes(drink_id):
         (drink_id,)
     ).fetchall()
 
-def generate_attribute_options(attribute_id, correct_value, db):
+def get_drink_attrs_with_options(drink_id):
+    """以一次 JOIN 取回指定飲料的所有屬性及其預先產生的選項，回傳 [(屬性, 出題用選項), ...]。"""
+    db = get_db()
+    rows = db.execute(
+        '''SELECT da.*, dao.option_value, dao.is_correct
+           FROM drink_attributes da
+           LEFT JOIN drink_attribute_options dao ON dao.attribute_id = da.id
+           WHERE da.drink_id = ?
+           ORDER BY da.id, dao.id''',
+        (drink_id,)
+    ).fetchall()
+    return list(group_attribute_options(rows))
+
+def _drink_filter_where(has_category, has_name, prefix=''):
+    """組出測驗篩選條件的 WHERE 子句內容（不含 WHERE 關鍵字）。"""
+    clauses = []
+    if has_category:
+        clauses.append(f"{prefix}category = ?")
+    if has_name:
+        clauses.append(f"{prefix}name = ?")
+    return " AND ".join(clauses)
+
+def _build_quiz_sql():
     """
-    為指定屬性生成下拉式選單的選項。
+    預先組好測驗用的 SQL：篩選組合只有「分類 × 飲料名稱」四種，
+    每次請求只需查表，SQLite 也能重複使用已編譯的語句。
+    """
+    drink_sql = {}
+    price_sql = {}
+    for has_category in (False, True):
+        for has_name in (False, True):
+            # 只取符合條件的飲料 id（分類篩選可直接走 idx_drinks_category_id），抽樣後再依主鍵取回
+            where = _drink_filter_where(has_category, has_name)
+            drink_sql[has_category, has_name] = f"SELECT id FROM drinks {'WHERE ' + where if where else ''}"
+
+            # 價錢測驗只取候選題目的 id，抽樣後再依主鍵取回完整資料
+            price_where = _drink_filter_where(has_category, has_name, prefix='d.')
+            price_sql[has_category, has_name] = f'''
+                SELECT da.id
+                FROM drink_attributes da
+                JOIN drinks d ON da.drink_id = d.id
+                WHERE {price_where + ' AND ' if price_where else ''}da.attribute_name = '價錢'
+            '''
+
+    price_fetch_sql = {}
+    for count in range(1, PRICE_QUIZ_SIZE + 1):
+        price_fetch_sql[count] = f'''
+            SELECT da.*, d.name as drink_name, d.category, d.id as drink_id,
+                   dao.option_value, dao.is_correct
+            FROM drink_attributes da
+            JOIN drinks d ON da.drink_id = d.id
+            LEFT JOIN drink_attribute_options dao ON dao.attribute_id = da.id
+            WHERE da.id IN ({", ".join("?" * count)})
+            ORDER BY da.id, dao.id
+        '''
+    return drink_sql, price_sql, price_fetch_sql
+
+_DRINK_PICK_SQL, _PRICE_QUIZ_SQL, _PRICE_FETCH_SQL = _build_quiz_sql()
+_DRINK_BY_ID_SQL = 'SELECT id, category, name FROM drinks WHERE id = ?'
+
+def pick_random_drink(db, category=None, name=None):
+    """
+    隨機選取一杯符合條件的飲料（category / name 為 None 表示不篩選）。
+    以 id 清單抽樣取代 ORDER BY RANDOM()，每杯飲料被選中的機率相同，且不必排序整張表：
+    - 沒有篩選條件時，從快取的飲料 id 清單隨機挑一個，再依主鍵取回
+    - 有篩選條件時，先取出符合條件的 id，再隨機挑一個依主鍵取回
+    """
+    params = [value for value in (category, name) if value is not None]
+
+    if not params:
+        get_unique_categories_and_drinks()
+        drink_ids = _CAT_CACHE['ids']
+        if drink_ids:
+            drink = db.execute(_DRINK_BY_ID_SQL, (random.choice(drink_ids),)).fetchone()
+            # 其他行程剛刪除的飲料可能還在快取中，查不到時改為直接查詢 id 清單
+            if drink:
+                return drink
+
+    drink_ids = [row[0] for row in db.execute(_DRINK_PICK_SQL[category is not None, name is not None], params)]
+    if not drink_ids:
+        return None
+    return db.execute(_DRINK_BY_ID_SQL, (random.choice(drink_ids),)).fetchone()
+
+def format_option_value(value):
+    """格式化選項數字 (去除不必要的小數點)"""
+    return str(int(value)) if value == int(value) else str(value)
+
+def enumerate_option_values(correct_num, step, options_before, options_after):
+    """
+    以正確答案為中心，依間格列舉前 options_before 個、後 options_after 個數值（純數值運算，不含格式化）。
+    每一項直接以乘法算出並捨入到小數 10 位，避免逐次累加的浮點誤差；正確答案本身原樣保留。
+    """
+    return [
+        round(correct_num + step * i, 10) if i else correct_num
+        for i in range(-options_before, options_after + 1)
+    ]
+
+# 出題時正確答案前後各顯示幾個選項（隨機）；預先存入資料庫的是數量最多的一組，出題時再隨機裁切
+OPTIONS_BEFORE_RANGE = (2, 4)
+OPTIONS_AFTER_RANGE = (3, 5)
+
+def build_attribute_options(correct_value, options_before, options_after):
+    """
+    依正確答案列出下拉式選單的選項（由小到大），並回傳正確答案在列表中的位置。
     邏輯：
     - 如果答案是10的倍數，每10間格生成選項
     - 考慮順序：10, 5, 0.5
-    - 最小為0，最大不超過正確答案的2倍
+    - 正確答案前後各 options_before / options_after 個間格，最小不低於 0
     """
-    # 首先嘗試從資料庫中獲取已定義的選項
-    predefined_options = db.execute(
-        'SELECT option_value FROM drink_attribute_options WHERE attribute_id = ? ORDER BY is_correct DESC',
-        (attribute_id,)
-    ).fetchall()
-    
-    if predefined_options:
-        return [opt['option_value'] for opt in predefined_options]
-    
-    # 如果沒有預定義選項，則生成預設選項
-    options_list = []
-    
     try:
         correct_num = float(correct_value)
     except ValueError:
-        # 非數字答案，返回空列表讓前端顯示預設
-        return [str(correct_value)]
-    
-    max_value = correct_num * 2  # 最大值 = 正確答案的2倍
+        correct_num = None
+    if correct_num is None or not math.isfinite(correct_num):
+        # 非數字答案（float() 接受的 nan、inf 也算），只有正確答案一個選項
+        return [str(correct_value)], 0
     
     # 判斷增量：10, 5, 0.5
     if correct_num >= 10 and correct_num % 10 == 0:
@@ -164,33 +385,71 @@ def generate_attribute_options(attribute_id, correct_value, db):
         # 其他情況，按10的倍數計算
         step = 10 if correct_num >= 10 else 5
     
-    # 加入隨機性：正確答案前後的選項數量隨機變化
-    # 前面: 2-4 個選項，後面: 3-5 個選項
-    options_before = random.randint(2, 4)  # 正確答案前面的選項數
-    options_after = random.randint(3, 5)   # 正確答案後面的選項數
-    
-    min_value = max(0, correct_num - step * options_before)
-    max_value = correct_num + step * options_after
-    
-    # 生成所有可能的選項
-    current = min_value
-    while current <= max_value:
-        # 格式化數字 (去除不必要的小數點)
-        if current == int(current):
-            options_list.append(str(int(current)))
-        else:
-            options_list.append(str(current))
-        current += step
+    # 往下會低於 0 時，只取到仍不小於 0 的最後一個間格（而不是從 0 開始），
+    # 所有選項都與正確答案落在同一組間格上，正確答案不會是唯一不對齊的那一個
+    options_before = max(0, min(options_before, int(correct_num // step)))
     
-    # 確保正確答案在列表中
-    correct_str = str(int(correct_num)) if correct_num == int(correct_num) else str(correct_num)
-    if correct_str not in options_list:
-        options_list.append(correct_str)
+    # 生成所有選項（由小到大、不重複，先以數值處理，最後才轉成字串）
+    option_values = enumerate_option_values(correct_num, step, options_before, options_after)
     
-    # 排序從小到大 (移除隨機打亂)
-    options_list = sorted(list(set(options_list)), key=lambda x: float(x))
+    return [format_option_value(value) for value in option_values], options_before
+
+def store_attribute_options(db, drink_id=None):
+    """
+    為還沒有選項的屬性預先產生選項並寫入 drink_attribute_options（依 id 由小到大排列），
+    出題時只需查詢與隨機裁切。drink_id 為 None 時處理所有飲料。
+    查詢與寫入在同一個交易中完成（尚未開始交易時先取得寫入鎖），其他連線不會在中間補上同一批選項；由呼叫者 commit。
+    """
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+    query = '''SELECT da.id, da.attribute_value FROM drink_attributes da
+               WHERE NOT EXISTS (SELECT 1 FROM drink_attribute_options dao WHERE dao.attribute_id = da.id)'''
+    params = ()
+    if drink_id is not None:
+        query += ' AND da.drink_id = ?'
+        params = (drink_id,)
     
-    return options_list
+    option_rows = []
+    for attribute_id, attribute_value in db.execute(query, params).fetchall():
+        options, correct_index = build_attribute_options(
+            attribute_value, OPTIONS_BEFORE_RANGE[1], OPTIONS_AFTER_RANGE[1]
+        )
+        option_rows.extend(
+            (attribute_id, option, 1 if i == correct_index else 0)
+            for i, option in enumerate(options)
+        )
+    db.executemany(
+        'INSERT INTO drink_attribute_options (attribute_id, option_value, is_correct) VALUES (?, ?, ?)',
+        option_rows
+    )
+
+def trim_attribute_options(options, correct_index):
+    """加入隨機性：從預先產生的選項中保留正確答案前 2-4 個、後 3-5 個選項。"""
+    if correct_index is None:
+        return options
+    options_before = random.randint(*OPTIONS_BEFORE_RANGE)
+    options_after = random.randint(*OPTIONS_AFTER_RANGE)
+    return options[max(0, correct_index - options_before):correct_index + options_after + 1]
+
+def group_attribute_options(rows):
+    """
+    將「屬性 LEFT JOIN 選項」的查詢結果（依屬性 id、選項 id 排序）依屬性分組，
+    逐一產生 (屬性, 出題用選項)；沒有預先產生選項的屬性（例如尚未補齊的舊資料）才當場生成。
+    """
+    for _, group in itertools.groupby(rows, key=lambda row: row['id']):
+        group = list(group)
+        attr = group[0]
+        if attr['option_value'] is None:
+            # JOIN 已確認沒有預定義選項，直接生成，不必再查一次選項表
+            options, _ = build_attribute_options(
+                attr['attribute_value'],
+                random.randint(*OPTIONS_BEFORE_RANGE),  # 正確答案前面的選項數
+                random.randint(*OPTIONS_AFTER_RANGE),   # 正確答案後面的選項數
+            )
+        else:
+            correct_index = next((i for i, row in enumerate(group) if row['is_correct']), None)
+            options = trim_attribute_options([row['option_value'] for row in group], correct_index)
+        yield attr, options
 
 # --- 網頁路由 (Routes) ---
 
@@ -199,10 +458,14 @@ def index():
     """首頁 - 顯示各功能選項"""
     return render_template('index.html')
 
-@app.route('/quiz', methods=['GET', 'POST'])
-def quiz():
-    """飲料選擇和測驗頁面"""
-    db = get_db()
+# 價錢題目中泛指飲料的詞彙，出題時會替換為具體飲料名稱（合併成單一正規表示式，一次掃描完成）
+GENERIC_DRINK_WORDS = ('這杯飲料', '這個食物', '此飲品', '該飲料')
+_GENERIC_DRINK_RE = re.compile('|'.join(map(re.escape, GENERIC_DRINK_WORDS)))
+# CSV 匯入時可接受的標題列開頭（小寫）
+IMPORT_HEADER_PREFIXES = (['category', 'drink name'], ['category', 'drink_name'])
+
+def render_quiz_form(message=None, selected_category='all', selected_drink='all', quiz_mode='all'):
+    """顯示測驗範圍選擇頁面；資料庫中沒有飲料時改為提示先新增飲料。"""
     all_categories, all_drinks = get_unique_categories_and_drinks()
 
     if not all_categories and not all_drinks:
@@ -212,249 +475,214 @@ def quiz():
                                all_drinks=[],
                                quiz_mode='all')
 
-    if request.method == 'POST':
-        selected_category = request.form.get('category_filter', 'all')
-        selected_drink = request.form.get('drink_filter', 'all')
-        quiz_mode = request.form.get('quiz_mode', 'all')  # 新增: 測驗模式
-        
-        where_clauses = []
-        params = []
-        
-        if selected_category and selected_category != 'all':
-            where_clauses.append("category = ?")
-            params.append(selected_category)
-        
-        if selected_drink and selected_drink != 'all':
-            where_clauses.append("name = ?")
-            params.append(selected_drink)
-        
-        sql_where = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
-        
-        # 價錢測驗模式：隨機選取 5 道價錢題目
-        if quiz_mode == 'price':
-            # 從所有符合條件的飲料中,隨機選取 5 個價錢屬性
-            price_query = f'''
-                SELECT da.*, d.name as drink_name, d.category, d.id as drink_id
-                FROM drink_attributes da
-                JOIN drinks d ON da.drink_id = d.id
-                {sql_where}
-                {"AND" if sql_where else "WHERE"} da.attribute_name = '價錢'
-                ORDER BY RANDOM()
-                LIMIT 5
-            '''
-            price_attributes = db.execute(price_query, params).fetchall()
-            
-            if not price_attributes:
-                return render_template('quiz.html', 
-                                       message="沒有找到符合條件的價錢題目。", 
-                                       all_categories=all_categories, 
-                                       all_drinks=all_drinks,
-                                       selected_category=selected_category,
-                                       selected_drink=selected_drink,
-                                       quiz_mode=quiz_mode)
-            
-            # 為每個價錢屬性生成選項
-            drink_questions = []
-            for attr in price_attributes:
-                options = generate_attribute_options(attr['id'], attr['attribute_value'], db)
-                
-                # 處理問題模板,確保題目中包含飲料名稱
-                question_text = attr['question_template'].replace('[NUM]', '____')
-                
-                # 替換各種可能的通用詞彙為具體飲料名稱
-                replacements = [
-                    ('這杯飲料', f"「{attr['drink_name']}」"),
-                    ('這個食物', f"「{attr['drink_name']}」"),
-                    ('此飲品', f"「{attr['drink_name']}」"),
-                    ('該飲料', f"「{attr['drink_name']}」"),
-                ]
-                
-                for old, new in replacements:
-                    question_text = question_text.replace(old, new)
-                
-                # 如果題目中沒有包含飲料名稱,在前面加上
-                if attr['drink_name'] not in question_text:
-                    question_text = f"「{attr['drink_name']}」{question_text}"
-                
-                drink_questions.append({
-                    'id': attr['id'],
-                    'name': attr['attribute_name'],
-                    'drink_name': attr['drink_name'],  # 添加飲料名稱
-                    'category': attr['category'],
-                    'question': question_text,
-                    'unit': '',  # 價錢測驗不顯示單位,因為已經在問題模板中
-                    'correct_answer': attr['attribute_value'],
-                    'options': options,
-                    'is_price': True  # 標記為價錢題目
-                })
-            
-            # 使用虛擬的 drink 物件
-            virtual_drink = {
-                'id': 0,
-                'name': '價錢測驗',
-                'category': '混合題目'
+    return render_template('quiz.html', 
+                           message=message,
+                           all_categories=all_categories, 
+                           all_drinks=all_drinks, 
+                           selected_category=selected_category, 
+                           selected_drink=selected_drink,
+                           quiz_mode=quiz_mode)
+
+@app.route('/quiz', methods=['GET'])
+def quiz():
+    """飲料選擇頁面"""
+    return render_quiz_form()
+
+@app.route('/quiz', methods=['POST'])
+def quiz_run():
+    """依選擇的範圍出題（只有找不到題目、需要重新顯示選擇頁面時才查詢分類清單）"""
+    db = get_db()
+    selected_category = request.form.get('category_filter', 'all')
+    selected_drink = request.form.get('drink_filter', 'all')
+    quiz_mode = request.form.get('quiz_mode', 'all')  # 新增: 測驗模式
+    
+    category_filter = selected_category if selected_category and selected_category != 'all' else None
+    drink_filter = selected_drink if selected_drink and selected_drink != 'all' else None
+    
+    # 價錢測驗模式：隨機選取 5 道價錢題目
+    if quiz_mode == 'price':
+        # 從所有符合條件的飲料中,隨機選取 5 個價錢屬性
+        price_query = _PRICE_QUIZ_SQL[category_filter is not None, drink_filter is not None]
+        params = [value for value in (category_filter, drink_filter) if value is not None]
+        candidate_ids = [row[0] for row in db.execute(price_query, params)]
+        price_attributes = []
+        if candidate_ids:
+            picked_ids = random.sample(candidate_ids, min(PRICE_QUIZ_SIZE, len(candidate_ids)))
+            # 題目與選項一起取回
+            rows_by_id = {
+                attr['id']: (attr, options)
+                for attr, options in group_attribute_options(
+                    db.execute(_PRICE_FETCH_SQL[len(picked_ids)], picked_ids).fetchall()
+                )
             }
-            
-            return render_template('quiz_question.html', 
-                                   drink=virtual_drink,
-                                   questions=drink_questions,
-                                   category_filter=selected_category,
-                                   drink_filter=selected_drink,
-                                   quiz_mode=quiz_mode,
-                                   is_price_quiz=True)
+            # 維持抽樣時的隨機順序
+            price_attributes = [rows_by_id[attr_id] for attr_id in picked_ids if attr_id in rows_by_id]
         
-        # 配料測驗或全部測驗模式：選取一個飲料
-        # 隨機選取一個飲料
-        query = f'SELECT * FROM drinks {sql_where} ORDER BY RANDOM() LIMIT 1'
-        drink = db.execute(query, params).fetchone()
+        if not price_attributes:
+            return render_quiz_form("沒有找到符合條件的價錢題目。", selected_category, selected_drink, quiz_mode)
         
-        if not drink:
-            return render_template('quiz.html', 
-                                   message="在所選的範圍內找不到飲料。", 
-                                   all_categories=all_categories, 
-                                   all_drinks=all_drinks,
-                                   selected_category=selected_category,
-                                   selected_drink=selected_drink,
-                                   quiz_mode=quiz_mode)
-
-        # 獲取該飲料的所有屬性
-        attributes = get_drink_attributes(drink['id'])
-        
-        # 根據測驗模式過濾屬性
-        if quiz_mode == 'price':
-            # 價錢測驗模式：只顯示屬性名稱為「價錢」的題目
-            attributes = [attr for attr in attributes if attr['attribute_name'] == '價錢']
-        elif quiz_mode == 'ingredient':
-            # 配料測驗模式：排除價錢，只顯示配料
-            attributes = [attr for attr in attributes if attr['attribute_name'] != '價錢']
-        # quiz_mode == 'all' 時不過濾，顯示所有屬性
-        
-        if not attributes:
-            mode_text = "價錢" if quiz_mode == 'price' else "配料" if quiz_mode == 'ingredient' else ""
-            return render_template('quiz.html', 
-                                   message=f"該飲料沒有配置{mode_text}題目。", 
-                                   all_categories=all_categories, 
-                                   all_drinks=all_drinks,
-                                   selected_category=selected_category,
-                                   selected_drink=selected_drink,
-                                   quiz_mode=quiz_mode)
-
-        # 為每個屬性生成選項
         drink_questions = []
-        for attr in attributes:
-            options = generate_attribute_options(attr['id'], attr['attribute_value'], db)
+        for attr, options in price_attributes:
+            # 處理問題模板,確保題目中包含飲料名稱
+            question_text = attr['rendered_question']
             
-            # 處理問題模板,加入飲料名稱讓題目更清楚
-            question_text = attr['question_template'].replace('[NUM]', '____')
+            # 替換各種可能的通用詞彙為具體飲料名稱
+            drink_label = f"「{attr['drink_name']}」"
+            question_text = _GENERIC_DRINK_RE.sub(lambda _: drink_label, question_text)
             
-            # 為配料測驗也在題目前加上飲料名稱
-            if quiz_mode != 'price' and drink:
-                # 如果題目中沒有包含飲料名稱,在前面加上
-                if drink['name'] not in question_text:
-                    question_text = f"「{drink['name']}」{question_text}"
+            # 如果題目中沒有包含飲料名稱,在前面加上
+            if attr['drink_name'] not in question_text:
+                question_text = f"「{attr['drink_name']}」{question_text}"
             
             drink_questions.append({
                 'id': attr['id'],
                 'name': attr['attribute_name'],
-                'drink_name': drink['name'] if drink else None,  # 添加飲料名稱
+                'drink_name': attr['drink_name'],  # 添加飲料名稱
+                'category': attr['category'],
                 'question': question_text,
-                'unit': attr['unit'],
+                'unit': '',  # 價錢測驗不顯示單位,因為已經在問題模板中
                 'correct_answer': attr['attribute_value'],
-                'options': options
+                'options': options,
+                'is_price': True  # 標記為價錢題目
             })
         
+        # 使用虛擬的 drink 物件
+        virtual_drink = {
+            'id': 0,
+            'name': '價錢測驗',
+            'category': '混合題目'
+        }
+        
         return render_template('quiz_question.html', 
-                               drink=drink,
+                               drink=virtual_drink,
                                questions=drink_questions,
                                category_filter=selected_category,
                                drink_filter=selected_drink,
-                               quiz_mode=quiz_mode)
+                               quiz_mode=quiz_mode,
+                               is_price_quiz=True)
+    
+    # 配料測驗或全部測驗模式：選取一個飲料
+    # 隨機選取一個飲料
+    drink = pick_random_drink(db, category_filter, drink_filter)
+    
+    if not drink:
+        return render_quiz_form("在所選的範圍內找不到飲料。", selected_category, selected_drink, quiz_mode)
 
-    return render_template('quiz.html', 
-                           all_categories=all_categories, 
-                           all_drinks=all_drinks, 
-                           selected_category='all', 
-                           selected_drink='all',
-                           quiz_mode='all')
+    # 獲取該飲料的所有屬性（連同選項一次取回）
+    attributes = get_drink_attrs_with_options(drink['id'])
+    
+    # 根據測驗模式過濾屬性
+    if quiz_mode == 'price':
+        # 價錢測驗模式：只顯示屬性名稱為「價錢」的題目
+        attributes = [(attr, options) for attr, options in attributes if attr['attribute_name'] == '價錢']
+    elif quiz_mode == 'ingredient':
+        # 配料測驗模式：排除價錢，只顯示配料
+        attributes = [(attr, options) for attr, options in attributes if attr['attribute_name'] != '價錢']
+    # quiz_mode == 'all' 時不過濾，顯示所有屬性
+    
+    if not attributes:
+        mode_text = "價錢" if quiz_mode == 'price' else "配料" if quiz_mode == 'ingredient' else ""
+        return render_quiz_form(f"該飲料沒有配置{mode_text}題目。", selected_category, selected_drink, quiz_mode)
+
+    drink_questions = []
+    for attr, options in attributes:
+        # 處理問題模板,加入飲料名稱讓題目更清楚
+        question_text = attr['rendered_question']
+        
+        # 為配料測驗也在題目前加上飲料名稱
+        if quiz_mode != 'price' and drink:
+            # 如果題目中沒有包含飲料名稱,在前面加上
+            if drink['name'] not in question_text:
+                question_text = f"「{drink['name']}」{question_text}"
+        
+        drink_questions.append({
+            'id': attr['id'],
+            'name': attr['attribute_name'],
+            'drink_name': drink['name'] if drink else None,  # 添加飲料名稱
+            'question': question_text,
+            'unit': attr['unit'],
+            'correct_answer': attr['attribute_value'],
+            'options': options
+        })
+    
+    return render_template('quiz_question.html', 
+                           drink=drink,
+                           questions=drink_questions,
+                           category_filter=selected_category,
+                           drink_filter=selected_drink,
+                           quiz_mode=quiz_mode)
 
 @app.route('/check_answer', methods=['POST'])
 def check_answer():
     """檢查答案並更新統計資訊"""
     db = get_db()
     
-    # 獲取所有的答題資料
-    form_data = request.form.to_dict()
+    # 直接讀取表單（MultiDict），不另外複製成 dict
+    form_data = request.form
     drink_id = form_data.get('drink_id')
     
     # 統計答題結果
     all_correct = True
     results = []
     
-    # 遍歷所有表單數據，找出所有的答案
-    for key in form_data.keys():
+    # 走訪表單一次，找出所有已作答的題目
+    answers = []
+    for key, user_choice in form_data.items():
         if key.startswith('choice_'):
             # 提取屬性ID
-            attribute_id = key.replace('choice_', '')
-            user_choice = form_data.get(f'choice_{attribute_id}')
-            correct_answer = form_data.get(f'correct_answer_{attribute_id}')
+            attribute_id = key[len('choice_'):]
             
             # 驗證必填欄位
-            if not user_choice or user_choice == '':
+            if not user_choice:
                 continue  # 跳過未作答的題目
             
-            # 取回 attribute 額外資訊（名稱/模板/單位/飲料名稱）
-            attr_row = None
-            drink_name = None
-            if attribute_id:
-                attr_row = db.execute(
-                    '''SELECT da.attribute_name, da.question_template, da.unit, d.name as drink_name
-                       FROM drink_attributes da
-                       JOIN drinks d ON da.drink_id = d.id
-                       WHERE da.id = ?''',
-                    (attribute_id,)
-                ).fetchone()
-
-            if attr_row:
-                attribute_name = attr_row['attribute_name']
-                question_template = attr_row['question_template']
-                unit = attr_row['unit']
-                drink_name = attr_row['drink_name']
-            else:
-                attribute_name = None
-                question_template = None
-                unit = None
-                drink_name = None
-                
+            answers.append((attribute_id, user_choice, form_data.get(f'correct_answer_{attribute_id}')))
+    
+    # 一次取回所有題目的 attribute 額外資訊（名稱/模板/單位/飲料名稱）
+    attr_ids = [attribute_id for attribute_id, _, _ in answers if attribute_id]
+    attr_rows = {}
+    if attr_ids:
+        attr_rows = {
+            str(row['id']): row
+            for row in db.execute(
+                f'''SELECT da.id, da.attribute_name, da.rendered_question, da.unit, d.name as drink_name
+                   FROM drink_attributes da
+                   JOIN drinks d ON da.drink_id = d.id
+                   WHERE da.id IN ({", ".join("?" * len(attr_ids))})''',
+                attr_ids
+            )
+        }
+    
+    stat_updates = []
+    for attribute_id, user_choice, correct_answer in answers:
+        attr_row = attr_rows.get(attribute_id)
+        if attr_row:
+            attribute_name = attr_row['attribute_name']
+            question_text = attr_row['rendered_question'] or None
+            unit = attr_row['unit']
+            drink_name = attr_row['drink_name']
+        else:
+            attribute_name = None
             question_text = None
-            if question_template:
-                question_text = question_template.replace('[NUM]', '____')
+            unit = None
+            drink_name = None
 
-            is_correct = (user_choice == correct_answer)
-            all_correct = all_correct and is_correct
+        is_correct = (user_choice == correct_answer)
+        all_correct = all_correct and is_correct
 
-            # 更新屬性的統計資訊
-            if attribute_id:
-                db.execute(
-                    'UPDATE drink_attributes SET times_attempted = times_attempted + 1 WHERE id = ?',
-                    (attribute_id,)
-                )
-
-                if is_correct:
-                    db.execute(
-                        'UPDATE drink_attributes SET times_correct = times_correct + 1 WHERE id = ?',
-                        (attribute_id,)
-                    )
+        if attribute_id:
+            stat_updates.append((1 if is_correct else 0, attribute_id))
 
-            results.append({
-                'correct': is_correct,
-                'attribute_id': attribute_id,
-                'attribute_name': attribute_name,
-                'drink_name': drink_name,  # 新增飲料名稱
-                'question_text': question_text,
-                'unit': unit,
-                'user_choice': user_choice,
-                'correct_answer': correct_answer
-            })
+        results.append({
+            'correct': is_correct,
+            'attribute_id': attribute_id,
+            'attribute_name': attribute_name,
+            'drink_name': drink_name,  # 新增飲料名稱
+            'question_text': question_text,
+            'unit': unit,
+            'user_choice': user_choice,
+            'correct_answer': correct_answer
+        })
     
     # 驗證是否有作答記錄
     if not results:
@@ -464,6 +692,14 @@ def check_answer():
                              request_form=form_data,
                              message="⚠️ 未檢測到任何作答，請確保至少回答一題。")
     
+    # 更新屬性的統計資訊（作答次數與答對次數以同一條語句批次更新）
+    db.executemany(
+        '''UPDATE drink_attributes
+           SET times_attempted = times_attempted + 1, times_correct = times_correct + ?
+           WHERE id = ?''',
+        stat_updates
+    )
+    
     # 更新飲料的掌握狀態：只要有一題錯就標記為未掌握
     if drink_id:
         mastery_status = 1 if all_correct else 0
@@ -486,21 +722,19 @@ def create_item():
         
         db = get_db()
         
-        # 檢查飲料是否已存在
-        existing = db.execute('SELECT id FROM drinks WHERE name = ?', (drink_name,)).fetchone()
-        if existing:
-            return render_template('create_item.html', message="❌ 此飲料名稱已存在")
-        
         try:
-            # 插入飲料基本資訊
-            cursor = db.execute(
-                'INSERT INTO drinks (category, name) VALUES (?, ?)',
+            # 插入飲料基本資訊；名稱已存在時不插入也不回傳 id，不必事先另外查詢
+            inserted = db.execute(
+                'INSERT INTO drinks (category, name) VALUES (?, ?) ON CONFLICT(name) DO NOTHING RETURNING id',
                 (category, drink_name)
-            )
-            drink_id = cursor.lastrowid
+            ).fetchone()
+            if inserted is None:
+                return render_template('create_item.html', message="❌ 此飲料名稱已存在")
+            drink_id = inserted['id']
             
-            # 處理屬性
+            # 處理屬性：先收集所有要新增的列，再以 executemany 一次寫入
             attribute_count = int(request.form.get('attribute_count', 1))
+            attr_rows = []
             for i in range(attribute_count):
                 attr_name = request.form.get(f'attribute_name_{i}')
                 attr_value = request.form.get(f'attribute_value_{i}')
@@ -508,14 +742,18 @@ def create_item():
                 attr_template = request.form.get(f'attribute_template_{i}')
                 
                 if attr_name and attr_value:
-                    db.execute(
-                        '''INSERT INTO drink_attributes 
-                           (drink_id, attribute_name, attribute_value, unit, question_template) 
-                           VALUES (?, ?, ?, ?, ?)''',
-                        (drink_id, attr_name, attr_value, attr_unit, attr_template)
-                    )
+                    attr_rows.append((drink_id, attr_name, attr_value, attr_unit, attr_template))
+            
+            db.executemany(
+                '''INSERT INTO drink_attributes 
+                   (drink_id, attribute_name, attribute_value, unit, question_template) 
+                   VALUES (?, ?, ?, ?, ?)''',
+                attr_rows
+            )
+            store_attribute_options(db, drink_id)
             
             db.commit()
+            invalidate_category_cache()
             return render_template('create_item.html', message="✅ 飲料及屬性建立成功！")
         
         except Exception as e:
@@ -529,16 +767,24 @@ def create_item():
 def manage_items():
     """管理飲料和屬性"""
     db = get_db()
-    drinks = db.execute('SELECT * FROM drinks ORDER BY category, name').fetchall()
+    # 以一次 JOIN 取回所有飲料及其屬性，沒有屬性的飲料也會保留一列
+    rows = db.execute('''
+        SELECT d.id, d.category, d.name, d.is_mastered,
+               da.id AS attribute_id, da.attribute_name, da.attribute_value, da.unit,
+               da.times_attempted, da.times_correct
+        FROM drinks d
+        LEFT JOIN drink_attributes da ON da.drink_id = d.id
+        ORDER BY d.category, d.name, da.id
+    ''').fetchall()
     all_categories, all_drink_names = get_unique_categories_and_drinks()
     
-    # 為每個飲料獲取屬性
+    # 依飲料分組整理屬性
     drinks_with_attrs = []
-    for drink in drinks:
-        attrs = get_drink_attributes(drink['id'])
+    for _, group in itertools.groupby(rows, key=lambda row: row['id']):
+        group = list(group)
         drinks_with_attrs.append({
-            'drink': drink,
-            'attributes': attrs
+            'drink': group[0],
+            'attributes': [row for row in group if row['attribute_id'] is not None]
         })
     
     return render_template('manage_items.html', 
@@ -572,7 +818,9 @@ def edit_item(drink_id):
             submitted_attr_ids = set()
             attribute_count = int(request.form.get('attribute_count', 0))
             
-            # 更新或新增屬性
+            # 依表單分成「更新現有屬性」與「新增屬性」兩批，各以 executemany 一次寫入
+            updates = []
+            inserts = []
             for i in range(attribute_count):
                 attr_id = request.form.get(f'attribute_id_{i}')
                 attr_name = request.form.get(f'attribute_name_{i}')
@@ -583,26 +831,39 @@ def edit_item(drink_id):
                 if attr_name and attr_value:
                     if attr_id:  # 更新現有屬性
                         submitted_attr_ids.add(attr_id)
-                        db.execute(
-                            '''UPDATE drink_attributes 
-                               SET attribute_name = ?, attribute_value = ?, unit = ?, question_template = ?
-                               WHERE id = ? AND drink_id = ?''',
-                            (attr_name, attr_value, attr_unit, attr_template, attr_id, drink_id)
-                        )
+                        updates.append((attr_name, attr_value, attr_unit, attr_template, attr_id, drink_id))
                     else:  # 新增屬性
-                        db.execute(
-                            '''INSERT INTO drink_attributes 
-                               (drink_id, attribute_name, attribute_value, unit, question_template) 
-                               VALUES (?, ?, ?, ?, ?)''',
-                            (drink_id, attr_name, attr_value, attr_unit, attr_template)
-                        )
+                        inserts.append((drink_id, attr_name, attr_value, attr_unit, attr_template))
+            
+            db.executemany(
+                '''UPDATE drink_attributes 
+                   SET attribute_name = ?, attribute_value = ?, unit = ?, question_template = ?
+                   WHERE id = ? AND drink_id = ?''',
+                updates
+            )
+            db.executemany(
+                '''INSERT INTO drink_attributes 
+                   (drink_id, attribute_name, attribute_value, unit, question_template) 
+                   VALUES (?, ?, ?, ?, ?)''',
+                inserts
+            )
             
             # 刪除未在表單中出現的屬性（使用者已移除的）
             attrs_to_delete = existing_attr_ids - submitted_attr_ids
-            for attr_id in attrs_to_delete:
-                db.execute('DELETE FROM drink_attributes WHERE id = ? AND drink_id = ?', (attr_id, drink_id))
+            db.executemany(
+                'DELETE FROM drink_attributes WHERE id = ? AND drink_id = ?',
+                [(attr_id, drink_id) for attr_id in attrs_to_delete]
+            )
+            
+            # 正確值可能已修改：重新產生這杯飲料所有屬性的選項（已刪除的屬性由外鍵連帶刪除）
+            db.execute(
+                'DELETE FROM drink_attribute_options WHERE attribute_id IN (SELECT id FROM drink_attributes WHERE drink_id = ?)',
+                (drink_id,)
+            )
+            store_attribute_options(db, drink_id)
             
             db.commit()
+            invalidate_category_cache()
             return redirect(url_for('manage_items'))
         
         except Exception as e:
@@ -623,8 +884,27 @@ def delete_item(drink_id):
     db = get_db()
     db.execute('DELETE FROM drinks WHERE id = ?', (drink_id,))
     db.commit()
+    invalidate_category_cache()
     return redirect(url_for('manage_items'))
 
+def iter_upload_lines(stream, encoding='utf-8'):
+    """
+    分塊讀取上傳串流、增量解碼，並把 \\r\\n 與 \\r 換行都轉成 \\n 後逐行產生（與通用換行模式相同）。
+    只使用 read()，不用 TextIOWrapper：舊版 Python 的 SpooledTemporaryFile 缺少 readable() 等方法，大檔上傳時會出錯。
+    """
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+    pending = ''
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        lines = (pending + decoder.decode(chunk, final=not chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
 @app.route('/import', methods=['GET', 'POST'])
 @auth.login_required
 def import_items():
@@ -641,16 +921,25 @@ def import_items():
         if not file.filename.endswith('.csv'):
             return render_template('import_items.html', message="檔案格式不正確，請上傳 CSV 檔案 (.csv)。")
 
-        stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-        csv_reader = csv.reader(stream)
+        # 分塊讀取上傳串流並增量解碼，不必先把整個檔案讀進記憶體
+        csv_reader = csv.reader(iter_upload_lines(file.stream))
         
         imported_count = 0
         skipped_count = 0
         processed_rows = 0
         created_drinks_count = 0
+        attr_rows = []
+        # 加入或忽略屬性（同飲品+屬性名不重複）
+        insert_attr_sql = '''INSERT OR IGNORE INTO drink_attributes 
+                             (drink_id, attribute_name, attribute_value, unit, question_template) 
+                             VALUES (?, ?, ?, ?, ?)'''
         db = get_db()
         
         try:
+            db.execute('BEGIN')
+            # 一次載入既有飲料的 名稱 -> id 對照，逐列處理時不必再查資料庫
+            name_to_id = {drink['name']: drink['id'] for drink in db.execute('SELECT id, name FROM drinks')}
+            header_checked = False
             for row in csv_reader:
                 # 略過空行
                 if not row or all((c.strip() == '' for c in row)):
@@ -659,10 +948,11 @@ def import_items():
                 # 去掉首尾空白
                 row = [col.strip() for col in row]
 
-                # 自動跳過標題列（支援 5 欄或 6 欄）
-                header_cells = [c.lower() for c in row]
-                if header_cells[:2] == ['category', 'drink name'] or header_cells[:2] == ['category', 'drink_name']:
-                    continue
+                # 自動跳過標題列（支援 5 欄或 6 欄）：只有第一個非空白列可能是標題
+                if not header_checked:
+                    header_checked = True
+                    if [c.lower() for c in row[:2]] in IMPORT_HEADER_PREFIXES:
+                        continue
 
                 # 支援兩種格式：
                 # 5欄：category, drink_name, attribute_name, attribute_value, question_template
@@ -683,27 +973,27 @@ def import_items():
                     continue
 
                 # 檢查或建立飲料
-                drink = db.execute('SELECT id FROM drinks WHERE name = ?', (drink_name,)).fetchone()
-                if not drink:
+                drink_id = name_to_id.get(drink_name)
+                if drink_id is None:
                     cursor = db.execute(
                         'INSERT INTO drinks (category, name) VALUES (?, ?)',
                         (category, drink_name)
                     )
-                    drink_id = cursor.lastrowid
+                    drink_id = name_to_id[drink_name] = cursor.lastrowid
                     created_drinks_count += 1
-                else:
-                    drink_id = drink['id']
-
-                # 加入或忽略屬性（同飲品+屬性名不重複）
-                db.execute(
-                    '''INSERT OR IGNORE INTO drink_attributes 
-                       (drink_id, attribute_name, attribute_value, unit, question_template) 
-                       VALUES (?, ?, ?, ?, ?)''',
-                    (drink_id, attr_name, attr_value, unit, template)
-                )
+
+                # 先收集屬性，每滿一批再一次寫入
+                attr_rows.append((drink_id, attr_name, attr_value, unit, template))
                 imported_count += 1
+                if len(attr_rows) >= IMPORT_BATCH_SIZE:
+                    db.executemany(insert_attr_sql, attr_rows)
+                    attr_rows.clear()
             
+            db.executemany(insert_attr_sql, attr_rows)
+            # 為新匯入的屬性預先產生選項
+            store_attribute_options(db)
             db.commit()
+            invalidate_category_cache()
             success_message = (
                 f"✅ 匯入成功！共處理 {processed_rows} 列資料，"
                 f"新增 {created_drinks_count} 杯飲料，新增/忽略 {imported_count} 條屬性資料。"
@@ -714,6 +1004,7 @@ def import_items():
             return render_template('import_items.html', message=success_message, is_success=True)
         
         except Exception as e:
+            db.rollback()
             return render_template('import_items.html', message=f"匯入時發生錯誤: {e}")
 
     return render_template('import_items.html')
@@ -725,40 +1016,42 @@ def export_items():
     db = get_db()
     
     try:
-        drinks = db.execute('SELECT * FROM drinks ORDER BY category, name').fetchall()
-        
-        if not drinks:
+        if not db.execute('SELECT 1 FROM drinks LIMIT 1').fetchone():
             return "資料庫中沒有飲料可以匯出。", 404
         
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # 寫入標題列
-        writer.writerow(['Category', 'Drink Name', 'Attribute Name', 'Attribute Value', 'Unit', 'Question Template'])
-        
-        # 寫入資料
-        for drink in drinks:
-            attrs = get_drink_attributes(drink['id'])
-            for attr in attrs:
-                writer.writerow([
-                    drink['category'],
-                    drink['name'],
-                    attr['attribute_name'],
-                    attr['attribute_value'],
-                    attr['unit'],
-                    attr['question_template']
-                ])
+        # 查詢先在這裡執行，SQL 錯誤仍會回傳 500；資料列則在回應送出時才逐列讀取
+        # （一次 JOIN 取回所有飲料屬性，欄位順序即為 CSV 欄位順序）
+        rows = db.execute('''
+            SELECT d.category, d.name, da.attribute_name, da.attribute_value, da.unit, da.question_template
+            FROM drinks d
+            JOIN drink_attributes da ON da.drink_id = d.id
+            ORDER BY d.category, d.name, da.id
+        ''')
         
-        csv_content = output.getvalue()
-        response = make_response(csv_content)
+        def generate():
+            """逐列產生 CSV 內容，整份檔案不必先組在記憶體中。"""
+            output = io.StringIO()
+            writer = csv.writer(output)
+            
+            def csv_line(values):
+                output.seek(0)
+                output.truncate(0)
+                writer.writerow(values)
+                return output.getvalue()
+            
+            # 寫入標題列
+            yield csv_line(['Category', 'Drink Name', 'Attribute Name', 'Attribute Value', 'Unit', 'Question Template'])
+            
+            for row in rows:
+                yield csv_line(row)
         
         timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f"drinks_export_{timestamp}.csv"
         
-        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8-sig'
-        
-        return response
+        return Response(stream_with_context(generate()), headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Content-Type': 'text/csv; charset=utf-8-sig',
+        })
     
     except Exception as e:
         return f"匯出失敗: {e}", 500
@@ -793,4 +1086,5 @@ def reset_mastery():
 
 if __name__ == '__main__':
     init_db()
+    print("✅ 資料庫表結構已建立成功！")
     app.run(debug=True)
@@ -1,64 +1,106 @@
 import csv
+import functools
 import re
 
 # 讀取舊 CSV
 input_file = 'quiz_items_export_20251220_234224.csv'
 output_file = 'new_upload.csv'
+# 讀寫檔案都用 1 MiB 緩衝區，減少系統呼叫次數
+FILE_BUFFER_SIZE = 1 << 20
 
-# 用來提取屬性名稱的函數
+# 提取屬性名稱用的正規表示式：三種模式合成一個，模組載入時編譯一次，每列只掃描字串一次
+# a: [NUM] 後面「的」之後的詞；b: 「需要 [NUM] ...的」之後的詞；c: 最後的備選方案
+_ATTRIBUTE_NAME_RE = re.compile(
+    r'(?P<a>\[NUM\]\s*[^\d\s][^\d]*?的\s*(?P<a2>[^。，；:："\']*))'
+    r'|(?P<b>需要\s*\[NUM\]\s*[^的]*?的\s*(?P<b2>[^。，；:："\']*))'
+    r'|(?P<c>\[NUM\].*?的\s*(?P<c2>\S+))'
+)
+
+# 屬性名稱在這些字元前結束（與上面模式 a/b 的結尾字元相同）
+_TERMINATORS = frozenset('。，；:："\'')
+
+def _read_term(text, start):
+    """從 start 開始讀到結束字元（或字串結尾）為止，去掉首尾空白。"""
+    end = start
+    while end < len(text) and text[end] not in _TERMINATORS:
+        end += 1
+    return text[start:end].strip()
+
+# 用來提取屬性名稱的函數（相同的敘述句只解析一次；快取有上限，檔案再大記憶體也不會一直成長）
+@functools.lru_cache(maxsize=4096)
 def extract_attribute_name(sentence_template):
     """
     從敘述句提取屬性名稱
     例如："黑咖啡(M)需要[NUM]ml的咖啡液。" -> "咖啡液"
+    常見的寫法直接以字串搜尋逐字掃描，結果與 _ATTRIBUTE_NAME_RE 相同；少見的寫法才交給正規表示式
     """
-    # 尋找 "[NUM]" 後面的內容
-    match = re.search(r'\[NUM\]\s*([^\d\s][^\d]*?)的\s*([^。，，；；:：""''\"\']*)[。，，；；:：""''\"\'ml\s]*', sentence_template)
-    if match:
-        # 返回 "的" 後面的詞
-        return match.group(2).strip()
+    text = sentence_template
+    num = text.find('[NUM]')
+    # 三種模式都需要 [NUM] 及其後的「的」
+    de = text.find('的', num + 5) if num >= 0 else -1
+    if de < 0:
+        return "配料"  # 預設值
     
-    # 如果上面的正規表達式不符合，嘗試另一個模式
-    match = re.search(r'需要\s*\[NUM\]\s*([^的]*?)的\s*([^。，，；；:：""''\"\']*)', sentence_template)
-    if match:
-        return match.group(2).strip()
+    # 模式 b：[NUM] 前面（可隔空白）緊接「需要」時，從「需要」開始的模式最先符合
+    before = num
+    while before > 0 and text[before - 1].isspace():
+        before -= 1
+    if before >= 2 and text.startswith('需要', before - 2):
+        return _read_term(text, de + 1)
+    
+    # 模式 a：[NUM] 後（可隔空白）第一個字不是數字，且到下一個「的」之前都沒有數字
+    start = num + 5
+    while start < len(text) and text[start].isspace():
+        start += 1
+    if start < len(text) and not text[start].isdecimal():
+        de = text.find('的', start + 1)
+        if de >= 0 and not any(c.isdecimal() for c in text[start:de]):
+            return _read_term(text, de + 1)
     
-    # 最後的備選方案
-    match = re.search(r'\[NUM\].*?的\s*(\S+)', sentence_template)
+    match = _ATTRIBUTE_NAME_RE.search(text)
     if match:
-        return match.group(1).strip()
+        # 依符合的模式（a/b/c）返回 "的" 後面的詞
+        return match.group(match.lastgroup + '2').strip()
     
     return "配料"  # 預設值
 
-# 讀取和轉換
-new_rows = []
+# 含有這些字元的欄位，csv.writer 會加上引號（逗號另外以欄位數檢查）
+_NEEDS_QUOTING_RE = re.compile(r'["\r\n]')
 
-with open(input_file, 'r', encoding='utf-8') as infile:
-    reader = csv.DictReader(infile)
+# 讀取、轉換並逐列寫入新 CSV（不先把所有資料收集到記憶體中）
+row_count = 0
+
+with open(input_file, 'r', encoding='utf-8', buffering=FILE_BUFFER_SIZE) as infile, \
+        open(output_file, 'w', newline='', encoding='utf-8', buffering=FILE_BUFFER_SIZE) as outfile:
+    # 以串列讀寫，欄位位置由標題列決定一次，每列不必建立 dict
+    reader = csv.reader(infile)
+    header = next(reader)
+    category_index = header.index('Category')
+    name_index = header.index('Item Name')
+    sentence_index = header.index('Sentence Template')
+    number_index = header.index('Correct Number')
+    
+    writer = csv.writer(outfile)
+    writer.writerow(('category', 'drink_name', 'attribute_name', 'attribute_value', 'question_template'))
     
     for row in reader:
-        category = row['Category']
-        drink_name = row['Item Name']
-        sentence = row['Sentence Template']
-        correct_num = row['Correct Number']
+        # 略過空行（與 DictReader 相同）
+        if not row:
+            continue
+        
+        sentence = row[sentence_index]
         
         # 提取屬性名稱
         attribute_name = extract_attribute_name(sentence)
         
-        new_rows.append({
-            'category': category,
-            'drink_name': drink_name,
-            'attribute_name': attribute_name,
-            'attribute_value': correct_num,
-            'question_template': sentence
-        })
-
-# 寫入新 CSV
-with open(output_file, 'w', newline='', encoding='utf-8') as outfile:
-    fieldnames = ['category', 'drink_name', 'attribute_name', 'attribute_value', 'question_template']
-    writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-    
-    writer.writeheader()
-    writer.writerows(new_rows)
+        # 欄位都不需要加引號時直接組成一行寫入（結果與 csv.writer 相同），否則交給 csv.writer
+        fields = (row[category_index], row[name_index], attribute_name, row[number_index], sentence)
+        line = ','.join(fields)
+        if line.count(',') == len(fields) - 1 and not _NEEDS_QUOTING_RE.search(line):
+            outfile.write(line + '\r\n')
+        else:
+            writer.writerow(fields)
+        row_count += 1
 
 print(f"✅ 轉換完成！新檔案已存檔在 {output_file}")
-print(f"共轉換 {len(new_rows)} 行資料")
+print(f"共轉換 {row_count} 行資料")